@@ -4,50 +4,151 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from app.routes import jobs
 from app.services.job_service import job_service
 import uvicorn
-import json
-from typing import List
+import asyncio
+from contextlib import asynccontextmanager
+import orjson
+from typing import Dict, Optional, Tuple
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Snapshot messages; within a frame only the latest one per job is sent
+_SNAPSHOT_TYPES = ("job_update", "jobs_updated")
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    def __init__(self, client_queue_size: int = 256, flush_interval: float = 0.05):
+        # Each client gets a bounded frame queue drained by its own writer task.
+        # Only mutated on the event loop and never across an await, so no lock is needed.
+        self.active_connections: Dict[WebSocket, Tuple[asyncio.Queue, asyncio.Task]] = {}
+        self.client_queue_size = client_queue_size
+        # Window for collecting updates into one frame after the first one arrives
+        self.flush_interval = flush_interval
+        self.dropped_frames = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._drain_task: Optional[asyncio.Task] = None
+        self._warned_unbound = False
+
+    def start(self):
+        """Bind to the running event loop and start the broadcast consumer"""
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._drain_task = asyncio.create_task(self._drain_loop())
+
+    async def stop(self):
+        """Stop the broadcast consumer; later broadcasts are dropped"""
+        self._loop = None
+        if self._drain_task:
+            self._drain_task.cancel()
+            try:
+                await self._drain_task
+            except asyncio.CancelledError:
+                pass
+            self._drain_task = None
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        queue = asyncio.Queue(maxsize=self.client_queue_size)
+        writer = asyncio.create_task(self._writer(websocket, queue))
+        self.active_connections[websocket] = (queue, writer)
         logger.info(f"WebSocket client connected. Total connections: {len(self.active_connections)}")
 
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+        client = self.active_connections.pop(websocket, None)
+        if client:
+            client[1].cancel()
             logger.info(f"WebSocket client disconnected. Total connections: {len(self.active_connections)}")
 
-    async def broadcast(self, message: dict):
-        """Broadcast message to all connected clients"""
-        disconnected = []
-        for connection in self.active_connections:
+    def broadcast(self, message: dict):
+        """Queue a message for the next broadcast frame. Safe to call from worker threads."""
+        key = None
+        if message.get("type") in _SNAPSHOT_TYPES:
+            key = (message["type"], message.get("job_id"))
+        self.broadcast_raw(orjson.dumps(message), key)
+
+    def broadcast_raw(self, payload: bytes, key: Optional[tuple] = None):
+        """Queue an already encoded JSON message. Messages sharing a key supersede each other within a frame."""
+        loop = self._loop
+        if loop is None:
+            if not self._warned_unbound:
+                self._warned_unbound = True
+                logger.warning("Broadcaster not started (app lifespan not run); dropping WebSocket updates")
+            return
+        loop.call_soon_threadsafe(self._queue.put_nowait, (key, payload))
+
+    async def _drain_loop(self):
+        """Coalesce everything queued since the last send into a single frame"""
+        while True:
+            batch = [await self._queue.get()]
+            await asyncio.sleep(self.flush_interval)
+            try:
+                while True:
+                    batch.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                pass
+            # Messages arrive encoded, so the frame is assembled without re-serializing them
+            frame = b'{"type":"batch","items":[' + b",".join(self._coalesce(batch)) + b"]}"
+            self._send_to_all(frame.decode())
+
+    @staticmethod
+    def _coalesce(batch: list) -> list:
+        """Keep only the latest payload per key.
+
+        Snapshots supersede each other, so a newer one replaces an older one and
+        takes its place at the end. Unkeyed deltas such as function_results are
+        all kept in order.
+        """
+        latest: Dict[tuple, int] = {}
+        for index, (key, _) in enumerate(batch):
+            if key is None:
+                continue
+            previous = latest.get(key)
+            if previous is not None:
+                batch[previous] = None
+            latest[key] = index
+        return [item[1] for item in batch if item is not None]
+
+    def _send_to_all(self, payload: str):
+        """Hand an encoded frame to every client's writer"""
+        # A slow client only backs up its own queue
+        for queue, _ in self.active_connections.values():
+            try:
+                queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                self.dropped_frames += 1
+                logger.warning(f"Client queue full, dropped frame ({self.dropped_frames} dropped so far)")
+
+    async def _writer(self, websocket: WebSocket, queue: asyncio.Queue):
+        """Send queued frames to a single client"""
+        while True:
+            payload = await queue.get()
             try:
-                await connection.send_json(message)
+                await websocket.send_text(payload)
             except Exception as e:
                 logger.error(f"Failed to send message to client: {e}")
-                disconnected.append(connection)
-
-        # Clean up disconnected clients
-        for conn in disconnected:
-            self.disconnect(conn)
+                # Clean up disconnected client
+                self.disconnect(websocket)
+                return
 
 # Global connection manager instance
 manager = ConnectionManager()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    manager.start()
+    yield
+    await manager.stop()
+
 app = FastAPI(
     title="C Code Analyzer API",
     description="API for analyzing C code and generating function flowcharts",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Add CORS middleware
@@ -82,4 +183,5 @@ async def root():
     return {"message": "C Code Analyzer API", "status": "running"}
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8080)
+    # Run by import string so job_service broadcasts through this same app.main manager
+    uvicorn.run("app.main:app", host="0.0.0.0", port=8080)
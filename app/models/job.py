@@ -1,7 +1,8 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, PrivateAttr
 from typing import List, Dict, Optional, Any
 from datetime import datetime
 from enum import Enum
+import time
 
 class JobStatus(str, Enum):
     QUEUED = "queued"
@@ -13,17 +14,38 @@ class FunctionResult(BaseModel):
     name: str
     mermaid_diagram: str
     analysis: Optional[str] = None
+    # Position of the function among those found in the source
+    index: Optional[int] = None
 
 class Job(BaseModel):
     id: str
     code: str
+    code_hash: Optional[str] = None
     status: JobStatus = JobStatus.QUEUED
     created_at: datetime = datetime.now()
-    updated_at: datetime = datetime.now()
+    # Raw clock reading; converted to a datetime only when serialized
+    updated_at_ns: int = Field(default_factory=time.time_ns)
     total_functions: int = 0
     processed_functions: int = 0
-    functions: List[FunctionResult] = []
+    # Results are kept column-wise so each new function can be broadcast as a delta,
+    # sorted by function_indexes (the functions' source positions)
+    function_indexes: List[int] = []
+    function_names: List[str] = []
+    mermaid_diagrams: List[str] = []
     error_message: Optional[str] = None
+    # job_update payload with this job's id already filled in, built on first broadcast
+    _update_template: Optional[str] = PrivateAttr(default=None)
+
+    @property
+    def updated_at(self) -> datetime:
+        return datetime.fromtimestamp(self.updated_at_ns / 1e9)
+
+    @property
+    def functions(self) -> List[FunctionResult]:
+        return [
+            FunctionResult(name=name, mermaid_diagram=diagram, index=index)
+            for index, name, diagram in zip(self.function_indexes, self.function_names, self.mermaid_diagrams)
+        ]
 
 class JobCreateRequest(BaseModel):
     code: str
@@ -1,10 +1,15 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request, Response
 from typing import List
+import hashlib
+import orjson
 from app.models.job import JobCreateRequest, JobResponse, JobDetailResponse
 from app.services.job_service import job_service
 
 router = APIRouter()
 
+# (job_service version, etag, body) of the last serialized job list
+_jobs_cache = None
+
 @router.post("/jobs", response_model=dict)
 async def create_job(request: JobCreateRequest):
     """Create a new analysis job"""
@@ -15,20 +20,30 @@ async def create_job(request: JobCreateRequest):
         raise HTTPException(status_code=500, detail=f"Failed to create job: {str(e)}")
 
 @router.get("/jobs", response_model=List[JobResponse])
-async def list_jobs():
+async def list_jobs(request: Request):
     """Get all jobs with their status"""
+    global _jobs_cache
     try:
-        jobs = job_service.get_all_jobs()
-        return [
-            JobResponse(
-                id=job.id,
-                status=job.status.value,
-                created_at=job.created_at,
-                total_functions=job.total_functions,
-                processed_functions=job.processed_functions
-            )
-            for job in jobs
-        ]
+        version = job_service.version
+        if _jobs_cache is None or _jobs_cache[0] != version:
+            jobs = job_service.get_all_jobs()
+            body = orjson.dumps([
+                JobResponse(
+                    id=job.id,
+                    status=job.status.value,
+                    created_at=job.created_at,
+                    total_functions=job.total_functions,
+                    processed_functions=job.processed_functions
+                ).model_dump()
+                for job in jobs
+            ])
+            etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+            _jobs_cache = (version, etag, body)
+
+        _, etag, body = _jobs_cache
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        return Response(content=body, media_type="application/json", headers={"ETag": etag})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to list jobs: {str(e)}")
 
@@ -51,7 +66,8 @@ async def get_job(job_id: str):
             functions=job.functions,
             error_message=job.error_message
         )
-        return response
+        # The model is already validated; encode it once instead of dumping to a dict for re-encoding
+        return Response(content=response.model_dump_json(), media_type="application/json")
     except HTTPException:
         raise
     except Exception as e:
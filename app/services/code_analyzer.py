@@ -1,163 +1,504 @@
 import subprocess
-import json
+import orjson
 import os
+import atexit
+import functools
+import itertools
+import hashlib
+import shutil
+import threading
 import tempfile
 import re
-from typing import List
+from typing import Any, Dict, List, Optional
+from collections import OrderedDict
 import logging
 
+try:
+    import tree_sitter_c
+    from tree_sitter import Language, Parser
+    _C_LANGUAGE = Language(tree_sitter_c.language())
+except ImportError:
+    _C_LANGUAGE = None
+
 logger = logging.getLogger(__name__)
 
+# Parsers are not thread-safe, so each worker thread gets its own
+_thread_state = threading.local()
+
+def _get_parser() -> 'Parser':
+    parser = getattr(_thread_state, 'parser', None)
+    if parser is None:
+        parser = _thread_state.parser = Parser(_C_LANGUAGE)
+    return parser
+
+# Nodes that can hold top-level definitions: conditional-compilation blocks,
+# extern "C" { ... } and regions the parser could only recover as errors
+_DEFINITION_CONTAINER_TYPES = frozenset({
+    'preproc_if', 'preproc_ifdef', 'preproc_else', 'preproc_elif', 'preproc_elifdef',
+    'linkage_specification', 'declaration_list', 'ERROR',
+})
+
+# Control-structure node kinds mapped to the structure types drawn in flowcharts
+_CONTROL_NODE_TYPES = {
+    'if_statement': 'if',
+    'for_statement': 'for',
+    'while_statement': 'while',
+    'return_statement': 'return',
+}
+
+# ast-grep rules for the control structures drawn in flowcharts, keyed by ruleId
+_CONTROL_RULE_IDS = ('if', 'for', 'while', 'return')
+_CONTROL_KEYWORDS = tuple(rule_id.encode() for rule_id in _CONTROL_RULE_IDS)
+_CONTROL_RULES_YAML = "\n---\n".join(
+    f"id: {rule_id}\nlanguage: c\nrule:\n  kind: {rule_id}_statement\n"
+    for rule_id in _CONTROL_RULE_IDS
+)
+
+# Per-process scratch directory for ast-grep inputs, removed at exit
+_WORK_DIR = tempfile.mkdtemp(prefix='sgin_')
+atexit.register(shutil.rmtree, _WORK_DIR, ignore_errors=True)
+
+# Input-file slots for ast-grep builds without --stdin. Slots are reused, so the
+# number of files is bounded by peak concurrency rather than by threads ever seen.
+_free_input_slots: List[int] = []
+_input_slots_lock = threading.Lock()
+_input_slot_numbers = itertools.count()
+
+def _write_control_rules() -> str:
+    """Write the control structure rules once per process for `ast-grep scan --rule`"""
+    path = os.path.join(_WORK_DIR, 'control_rules.yml')
+    with open(path, 'w') as f:
+        f.write(_CONTROL_RULES_YAML)
+    return path
+
+_CONTROL_RULES_FILE = _write_control_rules()
+
+# Marks the ast-grep command as not yet resolved (None means "not installed")
+_UNSET = object()
+
+def _parse_json_stream(output: bytes) -> list:
+    """Parse `--json=stream` output, one match object per line, straight from bytes"""
+    return [orjson.loads(line) for line in output.splitlines() if line.strip()]
+
+def _match_offset(match: dict) -> int:
+    """Start position of an ast-grep match, from byteOffset or line/column"""
+    range_info = match.get('range', {})
+    if 'byteOffset' in range_info:
+        return range_info['byteOffset'].get('start', 0)
+    start_info = range_info.get('start', {})
+    if 'line' in start_info:
+        # Use line number as approximate position
+        return start_info.get('line', 0) * 1000 + start_info.get('column', 0)
+    return 0
+
+# Flowchart fragment per structure type and the node the flow continues from
+# (None when the structure ends the flow); {prev} is the incoming node, {n} the structure index
+_FLOWCHART_TEMPLATES = {
+    'for': (
+        "    {prev} --> FOR{n}{{For Loop}}\n"
+        "    FOR{n} -->|True| FORBODY{n}[Loop Body]\n"
+        "    FORBODY{n} --> FOR{n}\n"
+        "    FOR{n} -->|False| FOREXIT{n}[Continue]",
+        "FORBODY{n}",
+    ),
+    'while': (
+        "    {prev} --> WHILE{n}{{While}}\n"
+        "    WHILE{n} -->|True| WHILEBODY{n}[Body]\n"
+        "    WHILEBODY{n} --> WHILE{n}\n"
+        "    WHILE{n} -->|False| WHILEEXIT{n}[Continue]",
+        "WHILEBODY{n}",
+    ),
+    'if': (
+        "    {prev} --> IF{n}{{If}}\n"
+        "    IF{n} -->|Yes| THEN{n}[Then]\n"
+        "    IF{n} -->|No| MERGE{n}[Continue]\n"
+        "    THEN{n} --> MERGE{n}",
+        "MERGE{n}",
+    ),
+    'if_else': (
+        "    {prev} --> IF{n}{{If}}\n"
+        "    IF{n} -->|Yes| THEN{n}[Then]\n"
+        "    IF{n} -->|No| ELSE{n}[Else]\n"
+        "    THEN{n} --> MERGE{n}[Continue]\n"
+        "    ELSE{n} --> MERGE{n}",
+        "MERGE{n}",
+    ),
+    'return': (
+        "    {prev} --> RETURN{n}[Return]\n"
+        "    RETURN{n} --> END([End])",
+        None,
+    ),
+}
+
+def _control_structure(struct_type: str, start: int, function_code: str) -> dict:
+    """Structure entry consumed by _build_flowchart_from_structures"""
+    struct = {'type': struct_type, 'start': start}
+    if struct_type == 'if':
+        # Check for else-if by looking at the code
+        code_snippet = function_code[start:start+500] if start < len(function_code) else ""
+        has_else = 'else' in code_snippet
+        is_else_if = 'else if' in code_snippet or 'elseif' in code_snippet
+        struct['has_else'] = has_else and not is_else_if
+        struct['is_else_if'] = is_else_if
+    return struct
+
+# Keywords ast-grep can mistake for function names
+_C_KEYWORDS = frozenset({
+    'if', 'for', 'while', 'do', 'switch', 'case', 'default',
+    'break', 'continue', 'return', 'goto', 'sizeof'
+})
+
+# Function definitions recognised by the regex fallback
+_FN_RE = re.compile(r'^\s*(?:int|void|char|float|double)\s+(\w+)\s*\([^)]*\)\s*\{', re.MULTILINE)
+
+# Characters that can change brace-matching state in _extract_function_code
+_BRACE_RE = re.compile(r'[{}"\\]')
+
+# Definition header ending right before a top-level "{"; group 2 is the function name
+_HEADER_TAIL_RE = re.compile(r'(\w+\s+)?(\w+)\s*\([^)]*\)\s*\Z')
+
+@functools.lru_cache(maxsize=512)
+def _function_header_re(function_name: str) -> re.Pattern:
+    """Compiled pattern for the definition header of a named function"""
+    return re.compile(rf'(\w+\s+)?{re.escape(function_name)}\s*\([^)]*\)\s*{{')
+
+def hash_code(code: str) -> str:
+    """Stable key for a C source, used to memoize analysis results"""
+    return hashlib.blake2b(code.encode(), digest_size=16).hexdigest()
+
+class _LRUCache:
+    """Small thread-safe LRU map shared by all analyzers"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[tuple, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Any:
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key: tuple, value: Any):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+# Detected functions and diagrams keyed by source hash, so resubmitted code skips ast-grep
+_analysis_cache = _LRUCache(maxsize=256)
+
+# (tree, name -> function_definition node) keyed by source hash, so a job's
+# function lookup and every per-function diagram share a single parse
+_tree_cache = _LRUCache(maxsize=64)
+
+def _get_tree(code: str, code_hash: Optional[str] = None) -> tuple:
+    """Parse code with tree-sitter, reusing the cached tree for the same source"""
+    key = code_hash or hash_code(code)
+    parsed = _tree_cache.get(key)
+    if parsed is None:
+        tree = _get_parser().parse(code.encode())
+        nodes = {}
+        # Depth-first in source order, descending into #if/#ifdef branches and extern blocks
+        stack = list(reversed(tree.root_node.children))
+        while stack:
+            node = stack.pop()
+            if node.type in _DEFINITION_CONTAINER_TYPES:
+                stack.extend(reversed(node.children))
+                continue
+            if node.type != 'function_definition':
+                continue
+
+            # Unwrap pointer/function declarators down to the name identifier
+            declarator = node.child_by_field_name('declarator')
+            while declarator is not None and declarator.type != 'identifier':
+                declarator = declarator.child_by_field_name('declarator')
+            if declarator is not None:
+                nodes.setdefault(declarator.text.decode(), node)
+
+        parsed = (tree, nodes)
+        _tree_cache.put(key, parsed)
+    return parsed
+
 class CodeAnalyzer:
+    # Resolved ast-grep command shared by every analyzer, filled in on first use
+    _AST_GREP_CMD = _UNSET
+    _ast_grep_lock = threading.Lock()
+    # Flipped off the first time the installed ast-grep rejects --stdin
+    _stdin_supported = True
+
     def __init__(self):
-        pass
+        # Resolve ast-grep up front when it is the parser in use; the result is
+        # cached for the process lifetime. With tree-sitter it is never probed.
+        if _C_LANGUAGE is None:
+            self._find_ast_grep()
+        # (source, name -> definition) for the most recently split source
+        self._bodies_cache = ('', {})
         
-    def find_functions(self, code: str) -> List[str]:
-        """Use ast-grep to find all function definitions in C code"""
+    @property
+    def uses_subprocesses(self) -> bool:
+        """Whether analysis spawns ast-grep, i.e. tree-sitter is not installed"""
+        return _C_LANGUAGE is None
+
+    def find_functions(self, code: str, code_hash: Optional[str] = None) -> List[str]:
+        """Find all function definitions in C code, memoized on the source hash"""
+        key = ('functions', code_hash or hash_code(code))
+        cached = _analysis_cache.get(key)
+        if cached is not None:
+            return list(cached)
+
+        functions = self._find_functions(code, key[1])
+        if functions is None:
+            # Not cached, so a transient ast-grep failure isn't remembered
+            return self._fallback_function_extraction(code)
+
+        _analysis_cache.put(key, tuple(functions))
+        return functions
+
+    def _find_functions(self, code: str, code_hash: Optional[str] = None) -> Optional[List[str]]:
+        """Use tree-sitter, else ast-grep, to find all function definitions in C code.
+
+        Returns None when the caller should fall back to regex extraction.
+        """
+        if _C_LANGUAGE is not None:
+            return self._find_functions_in_tree(code, code_hash)
+
         ast_grep_cmd = self._find_ast_grep()
         
         if not ast_grep_cmd:
             logger.info("ast-grep not found in any of the checked locations, using regex fallback for function detection")
-            return self._fallback_function_extraction(code)
+            return None
 
         try:
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.c', delete=False) as f:
-                f.write(code)
-                temp_file = f.name
+            pattern = '$_ $FUNCNAME($_) { $$$ }'
 
-            try:
+            cmd = [
+                ast_grep_cmd, 'run',
+                '--pattern', pattern,
+                '--lang', 'c',
+                '--json=stream'  # One compact JSON object per match
+            ]
 
-                pattern = '$_ $FUNCNAME($_) { $$$ }'
-
-                cmd = [
-                    ast_grep_cmd, 'run',
-                    '--pattern', pattern,
-                    '--lang', 'c',
-                    '--json',  # Ensure JSON output
-                    temp_file
-                ]
-
-                logger.info(f"Running ast-grep command: {' '.join(cmd)}")
-                result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-
-                if result.returncode == 0 and result.stdout.strip():
-                    try:
-                        # Parse ast-grep JSON output
-                        # ast-grep returns a JSON array when using --json flag
-                        matches = json.loads(result.stdout)
-
-                        function_names = []
-                        for match in matches:
-                            # Extract function name from meta variables
-                            if 'meta_variables' in match and '$FUNCNAME' in match['meta_variables']:
-                                func_vars = match['meta_variables']['$FUNCNAME']
-                                if isinstance(func_vars, list) and len(func_vars) > 0:
-                                    func_name = func_vars[0].get('text', '')
-                                elif isinstance(func_vars, dict):
-                                    func_name = func_vars.get('text', '')
-                                else:
-                                    func_name = str(func_vars) if func_vars else ''
-
-                                if func_name and func_name not in function_names:
-                                    # Filter out keywords and invalid names
-                                    if (not func_name.startswith('_') and
-                                        func_name not in {
-                                            'if', 'for', 'while', 'do', 'switch', 'case', 'default',
-                                            'break', 'continue', 'return', 'goto', 'sizeof'
-                                        }):
-                                        function_names.append(func_name)
-
-                        if function_names:
-                            logger.info(f"ast-grep found {len(function_names)} functions: {function_names}")
-                            return function_names
-                        else:
-                            logger.warning("ast-grep found no valid functions, using regex fallback")
-                            return self._fallback_function_extraction(code)
-
-                    except (json.JSONDecodeError, KeyError, IndexError) as e:
-                        logger.warning(f"Failed to parse ast-grep JSON output: {e}")
-                        logger.warning(f"ast-grep stdout: {result.stdout[:500]}")
-                        return self._fallback_function_extraction(code)
-                else:
-                    logger.warning(f"ast-grep command failed (exit code {result.returncode})")
-                    if result.stderr:
-                        logger.warning(f"ast-grep stderr: {result.stderr[:500]}")
-                    return self._fallback_function_extraction(code)
+            logger.info(f"Running ast-grep command: {' '.join(cmd)}")
+            result = self._run_ast_grep(cmd, code.encode(), timeout=30)
 
-            finally:
-                # Clean up temp file
+            # --json=stream prints nothing at all when there are no matches
+            if result.returncode == 0:
                 try:
-                    os.unlink(temp_file)
-                except OSError:
-                    pass
+                    # Parse ast-grep JSON output
+                    matches = _parse_json_stream(result.stdout)
+
+                    function_names = []
+                    seen = set()
+                    for match in matches:
+                        # Extract function name from meta variables
+                        if 'meta_variables' in match and '$FUNCNAME' in match['meta_variables']:
+                            func_vars = match['meta_variables']['$FUNCNAME']
+                            if isinstance(func_vars, list) and len(func_vars) > 0:
+                                func_name = func_vars[0].get('text', '')
+                            elif isinstance(func_vars, dict):
+                                func_name = func_vars.get('text', '')
+                            else:
+                                func_name = str(func_vars) if func_vars else ''
+
+                            # Filter out keywords and invalid names
+                            if (func_name and func_name not in seen and
+                                    func_name not in _C_KEYWORDS and not func_name.startswith('_')):
+                                seen.add(func_name)
+                                function_names.append(func_name)
+
+                    if function_names:
+                        logger.info(f"ast-grep found {len(function_names)} functions: {function_names}")
+                        return function_names
+                    else:
+                        logger.warning("ast-grep found no valid functions, using regex fallback")
+                        return None
+
+                except (orjson.JSONDecodeError, KeyError, IndexError) as e:
+                    logger.warning(f"Failed to parse ast-grep JSON output: {e}")
+                    logger.warning(f"ast-grep stdout: {result.stdout[:500].decode(errors='replace')}")
+                    return None
+            else:
+                logger.warning(f"ast-grep command failed (exit code {result.returncode})")
+                if result.stderr:
+                    logger.warning(f"ast-grep stderr: {result.stderr[:500].decode(errors='replace')}")
+                return None
 
         except Exception as e:
             logger.error(f"Error in find_functions: {e}")
-            return self._fallback_function_extraction(code)
+            return None
     
+    def _find_functions_in_tree(self, code: str, code_hash: Optional[str] = None) -> Optional[List[str]]:
+        """Collect top-level function definition names from an in-process parse"""
+        _, nodes = _get_tree(code, code_hash)
+
+        # Definitions are recorded in source order, first one wins
+        function_names = [
+            func_name for func_name in nodes
+            if func_name not in _C_KEYWORDS and not func_name.startswith('_')
+        ]
+        if not function_names:
+            logger.warning("tree-sitter found no valid functions, using regex fallback")
+            return None
+
+        logger.info(f"tree-sitter found {len(function_names)} functions: {function_names}")
+        return function_names
+
     def _fallback_function_extraction(self, code: str) -> List[str]:
         """Simple regex-based function extraction"""
-        pattern = r'^\s*(?:int|void|char|float|double)\s+(\w+)\s*\([^)]*\)\s*\{'
-        matches = re.findall(pattern, code, re.MULTILINE)
-        functions = list(set(matches))  # Remove duplicates
+        matches = _FN_RE.findall(code)
+        functions = list(dict.fromkeys(matches))  # Remove duplicates, keeping source order
         return functions
     
-    def generate_mermaid_diagram(self, code: str, function_name: str) -> str:
+    def generate_mermaid_diagram(self, code: str, function_name: str, code_hash: Optional[str] = None) -> str:
         try:
+            key = ('diagram', code_hash or hash_code(code), function_name)
+            cached = _analysis_cache.get(key)
+            if cached is not None:
+                return cached
+
             logger.info(f"Generating mermaid diagram for function: {function_name} using AST traversal")
 
             # Try AST-based generation first, fallback to basic diagram
             try:
-                return self._generate_mermaid_from_ast(code, function_name)
+                diagram = self._generate_mermaid_from_ast(code, function_name, key[1])
             except Exception as ast_error:
                 logger.warning(f"AST-based generation failed for {function_name}: {ast_error}, using basic diagram")
                 return self._generate_basic_mermaid(function_name)
 
+            # Only AST results are cached so a transient ast-grep failure isn't remembered
+            _analysis_cache.put(key, diagram)
+            return diagram
+
         except Exception as e:
             logger.error(f"Error generating Mermaid diagram for {function_name}: {e}")
             return self._generate_basic_mermaid(function_name)
     
     def _extract_function_code(self, code: str, function_name: str) -> str:
         # Find the function definition
-        pattern = rf'(\w+\s+)?{re.escape(function_name)}\s*\([^)]*\)\s*{{'
-        match = re.search(pattern, code)
+        match = _function_header_re(function_name).search(code)
         
         if not match:
             return f"{function_name}() {{ /* Function not found */ }}"
         
+        # Only {, }, " and \ can change the scan state, so let the regex engine
+        # find those and skip everything in between
         start_pos = match.start()
-        
-        # Find the matching closing brace
         brace_count = 0
         in_string = False
-        escape_next = False
-        
-        for i in range(start_pos, len(code)):
+        escaped_pos = -1
+
+        for special in _BRACE_RE.finditer(code, start_pos):
+            i = special.start()
+            if i == escaped_pos:
+                continue
+
             char = code[i]
-            
-            if escape_next:
-                escape_next = False
+            if char == '\\':  # skip the escaped character
+                escaped_pos = i + 1
+            elif char == '"':
+                in_string = not in_string
+            elif not in_string:
+                if char == '{':
+                    brace_count += 1
+                else:
+                    brace_count -= 1
+                    if brace_count == 0:
+                        return code[start_pos:i + 1]
+
+        return code[start_pos:]
+
+    def _get_function_bodies(self, code: str) -> Dict[str, str]:
+        """Function definitions for code, split once and reused across its functions"""
+        cached_code, bodies = self._bodies_cache
+        if cached_code != code:
+            bodies = self._split_all_functions(code)
+            self._bodies_cache = (code, bodies)
+        return bodies
+
+    def _split_all_functions(self, code: str) -> Dict[str, str]:
+        """Map each top-level function name to its full definition in a single pass"""
+        bodies = {}
+        brace_count = 0
+        in_string = False
+        escaped_pos = -1
+        segment_start = 0
+        block_start = 0
+        name = None
+
+        # Same scan rules as _extract_function_code, applied to the whole source
+        for special in _BRACE_RE.finditer(code):
+            i = special.start()
+            if i == escaped_pos:
                 continue
-                
+
+            char = code[i]
             if char == '\\':
-                escape_next = True
-                continue
-                
-            if char == '"' and not escape_next:
+                escaped_pos = i + 1
+            elif char == '"':
                 in_string = not in_string
-                continue
-                
-            if not in_string:
+            elif not in_string:
                 if char == '{':
+                    if brace_count == 0:
+                        # Only blocks preceded by a "name(params)" header are functions
+                        header = _HEADER_TAIL_RE.search(code, segment_start, i)
+                        name = header.group(2) if header else None
+                        block_start = header.start() if header else i
                     brace_count += 1
-                elif char == '}':
+                elif brace_count > 0:
                     brace_count -= 1
                     if brace_count == 0:
-                        return code[start_pos:i+1]
-        
-        return code[start_pos:]
-    
-    def _find_ast_grep(self) -> str:
+                        if name and name not in bodies:
+                            bodies[name] = code[block_start:i + 1]
+                        segment_start = i + 1
+
+        return bodies
+
+    def _run_ast_grep(self, cmd: List[str], source: bytes, timeout: int) -> subprocess.CompletedProcess:
+        """Run ast-grep over source, piping it through stdin when the installed version allows"""
+        if CodeAnalyzer._stdin_supported:
+            result = subprocess.run(cmd + ['--stdin'], input=source, capture_output=True, timeout=timeout)
+            if result.returncode == 0 or b'--stdin' not in result.stderr:
+                return result
+            logger.warning("ast-grep does not accept --stdin, falling back to a reusable input file")
+            CodeAnalyzer._stdin_supported = False
+
+        # Borrow a slot file, rewritten in place rather than created and unlinked per call
+        with _input_slots_lock:
+            slot = _free_input_slots.pop() if _free_input_slots else next(_input_slot_numbers)
+        try:
+            input_path = os.path.join(_WORK_DIR, f'input-{slot}.c')
+            with open(input_path, 'wb') as f:
+                f.write(source)
+            # Don't hand the child the server's stdin; stderr is kept for the failure log
+            return subprocess.run(cmd + [input_path], stdin=subprocess.DEVNULL,
+                                  capture_output=True, timeout=timeout)
+        finally:
+            with _input_slots_lock:
+                _free_input_slots.append(slot)
+
+    def _find_ast_grep(self) -> Optional[str]:
+        return type(self)._resolve_ast_grep()
+
+    @classmethod
+    def _resolve_ast_grep(cls) -> Optional[str]:
+        """Locate ast-grep once per process; a miss is cached as None too"""
+        if cls._AST_GREP_CMD is _UNSET:
+            with cls._ast_grep_lock:
+                if cls._AST_GREP_CMD is _UNSET:
+                    cls._AST_GREP_CMD = cls._probe_ast_grep()
+        return cls._AST_GREP_CMD
+
+    @staticmethod
+    def _probe_ast_grep() -> Optional[str]:
+        configured = os.environ.get('AST_GREP_BIN')
+        if configured:
+            logger.info(f"Using ast-grep from AST_GREP_BIN: {configured}")
+            return configured
+
         ast_grep_paths = [
             'ast-grep',  # System PATH
             './ast-grep',  # Current directory
@@ -169,8 +510,9 @@ class CodeAnalyzer:
 
         for path in ast_grep_paths:
             try:
-                test_result = subprocess.run([path, '--version'],
-                                           capture_output=True, timeout=5)
+                # Only the exit code matters, so no pipes are set up
+                test_result = subprocess.run([path, '--version'], stdin=subprocess.DEVNULL,
+                                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=2)
                 if test_result.returncode == 0:
                     logger.info(f"Found ast-grep at: {path}")
                     return path
@@ -179,170 +521,89 @@ class CodeAnalyzer:
         
         return None
 
-    def _generate_mermaid_from_ast(self, code: str, function_name: str) -> str:
-        """Generate Mermaid diagram by analyzing control structures using ast-grep patterns"""
+    def _generate_mermaid_from_ast(self, code: str, function_name: str, code_hash: Optional[str] = None) -> str:
+        """Generate Mermaid diagram by analyzing control structures in the function's syntax tree"""
+        if _C_LANGUAGE is not None:
+            # Narrow to the function's node within the shared tree instead of re-parsing it
+            node = _get_tree(code, code_hash)[1].get(function_name)
+            if node is not None:
+                function_code = node.text.decode()
+            else:
+                # Name came from the regex fallback; parse just the extracted definition
+                function_code = self._get_function_bodies(code).get(function_name)
+                if function_code is None:
+                    function_code = self._extract_function_code(code, function_name)
+                if not function_code:
+                    raise Exception(f"Could not extract code for function {function_name}")
+                node = _get_parser().parse(function_code.encode()).root_node
+            structures = self._find_control_structures_in_tree(node, function_code)
+            return self._build_flowchart_from_structures(function_name, structures, function_code)
+
         ast_grep_cmd = self._find_ast_grep()
         if not ast_grep_cmd:
-            raise Exception("ast-grep not available for AST traversal")
+            raise Exception("Neither tree-sitter nor ast-grep available for AST traversal")
 
-        function_code = self._extract_function_code(code, function_name)
+        function_code = self._get_function_bodies(code).get(function_name)
+        if function_code is None:
+            function_code = self._extract_function_code(code, function_name)
         if not function_code:
             raise Exception(f"Could not extract code for function {function_name}")
 
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.c', delete=False) as f:
-            f.write(function_code)
-            temp_file = f.name
+        # Get all control structures with their positions
+        structures = self._analyze_control_structures_with_positions(function_code, ast_grep_cmd)
 
-        try:
-            # Get all control structures with their positions
-            structures = self._analyze_control_structures_with_positions(function_code, ast_grep_cmd, temp_file)
-            
-            # Build diagram based on actual code flow
-            return self._build_flowchart_from_structures(function_name, structures, function_code)
+        # Build diagram based on actual code flow
+        return self._build_flowchart_from_structures(function_name, structures, function_code)
 
-        finally:
-            try:
-                os.unlink(temp_file)
-            except OSError:
-                pass
+    def _find_control_structures_in_tree(self, function_node, function_code: str) -> list:
+        """Collect control structures with their positions in one walk of the function's subtree"""
+        # Positions are relative to the start of the function, as with ast-grep on the sliced body
+        base = function_node.start_byte
+
+        structures = []
+        stack = [function_node]
+        while stack:
+            node = stack.pop()
+            struct_type = _CONTROL_NODE_TYPES.get(node.type)
+            if struct_type:
+                structures.append(_control_structure(struct_type, node.start_byte - base, function_code))
+            stack.extend(node.children)
+
+        # Sort by position in code
+        structures.sort(key=lambda x: x.get('start', 0))
+        logger.info(f"Found {len(structures)} control structures: {[s['type'] for s in structures]}")
+        return structures
 
-    def _analyze_control_structures_with_positions(self, function_code: str, ast_grep_cmd: str, temp_file: str) -> list:
+    def _analyze_control_structures_with_positions(self, function_code: str, ast_grep_cmd: str) -> list:
         """Analyze function code for control structures with their positions using ast-grep"""
         structures = []
 
+        # Leaf functions have nothing for ast-grep to find, so skip the subprocess
+        source = function_code.encode()
+        if not any(keyword in source for keyword in _CONTROL_KEYWORDS):
+            return structures
+
         try:
-            # Use simpler patterns that ast-grep can match
-            # Pattern for if statements
-            if_pattern = 'if'
-            result = subprocess.run(
-                [ast_grep_cmd, 'run', '--pattern', if_pattern, '--lang', 'c', '--json', temp_file],
-                capture_output=True, text=True, timeout=10
-            )
-            if result.returncode == 0 and result.stdout.strip():
-                try:
-                    matches = json.loads(result.stdout)
-                    if isinstance(matches, list):
-                        for match in matches:
-                            # Get position from byteOffset or line/column
-                            start = 0
-                            if 'range' in match:
-                                range_info = match['range']
-                                if 'byteOffset' in range_info:
-                                    start = range_info['byteOffset'].get('start', 0)
-                                elif 'start' in range_info:
-                                    start_info = range_info['start']
-                                    if 'line' in start_info:
-                                        # Use line number as approximate position
-                                        line = start_info.get('line', 0)
-                                        col = start_info.get('column', 0)
-                                        start = line * 1000 + col  # Approximate
-                            
-                            # Check for else-if by looking at the code
-                            code_snippet = function_code[start:start+500] if start < len(function_code) else ""
-                            has_else = 'else' in code_snippet
-                            is_else_if = 'else if' in code_snippet or 'elseif' in code_snippet
-                            
-                            structures.append({
-                                'type': 'if',
-                                'start': start,
-                                'has_else': has_else and not is_else_if,
-                                'is_else_if': is_else_if
-                            })
-                            logger.info(f"Found if statement at position {start}")
-                except (json.JSONDecodeError, KeyError) as e:
-                    logger.warning(f"Failed to parse if pattern results: {e}")
-                    logger.debug(f"ast-grep output: {result.stdout[:500]}")
-
-            # Pattern for for loops
-            for_pattern = 'for'
-            result = subprocess.run(
-                [ast_grep_cmd, 'run', '--pattern', for_pattern, '--lang', 'c', '--json', temp_file],
-                capture_output=True, text=True, timeout=10
+            # One scan covers every rule; matches are told apart by ruleId
+            result = self._run_ast_grep(
+                [ast_grep_cmd, 'scan', '--rule', _CONTROL_RULES_FILE, '--json=stream'],
+                source, timeout=10
             )
             if result.returncode == 0 and result.stdout.strip():
                 try:
-                    matches = json.loads(result.stdout)
+                    matches = _parse_json_stream(result.stdout)
                     if isinstance(matches, list):
-                        for match in matches:
-                            start = 0
-                            if 'range' in match:
-                                range_info = match['range']
-                                if 'byteOffset' in range_info:
-                                    start = range_info['byteOffset'].get('start', 0)
-                                elif 'start' in range_info:
-                                    start_info = range_info['start']
-                                    if 'line' in start_info:
-                                        line = start_info.get('line', 0)
-                                        col = start_info.get('column', 0)
-                                        start = line * 1000 + col
-                            structures.append({
-                                'type': 'for',
-                                'start': start
-                            })
-                            logger.info(f"Found for loop at position {start}")
-                except (json.JSONDecodeError, KeyError) as e:
-                    logger.warning(f"Failed to parse for pattern results: {e}")
-                    logger.debug(f"ast-grep output: {result.stdout[:500]}")
-
-            # Pattern for while loops
-            while_pattern = 'while'
-            result = subprocess.run(
-                [ast_grep_cmd, 'run', '--pattern', while_pattern, '--lang', 'c', '--json', temp_file],
-                capture_output=True, text=True, timeout=10
-            )
-            if result.returncode == 0 and result.stdout.strip():
-                try:
-                    matches = json.loads(result.stdout)
-                    if isinstance(matches, list):
-                        for match in matches:
-                            start = 0
-                            if 'range' in match:
-                                range_info = match['range']
-                                if 'byteOffset' in range_info:
-                                    start = range_info['byteOffset'].get('start', 0)
-                                elif 'start' in range_info:
-                                    start_info = range_info['start']
-                                    if 'line' in start_info:
-                                        line = start_info.get('line', 0)
-                                        col = start_info.get('column', 0)
-                                        start = line * 1000 + col
-                            structures.append({
-                                'type': 'while',
-                                'start': start
-                            })
-                            logger.info(f"Found while loop at position {start}")
-                except (json.JSONDecodeError, KeyError) as e:
-                    logger.warning(f"Failed to parse while pattern results: {e}")
-
-            # Pattern for return statements
-            return_pattern = 'return'
-            result = subprocess.run(
-                [ast_grep_cmd, 'run', '--pattern', return_pattern, '--lang', 'c', '--json', temp_file],
-                capture_output=True, text=True, timeout=10
-            )
-            if result.returncode == 0 and result.stdout.strip():
-                try:
-                    matches = json.loads(result.stdout)
-                    if isinstance(matches, list):
-                        for match in matches:
-                            start = 0
-                            if 'range' in match:
-                                range_info = match['range']
-                                if 'byteOffset' in range_info:
-                                    start = range_info['byteOffset'].get('start', 0)
-                                elif 'start' in range_info:
-                                    start_info = range_info['start']
-                                    if 'line' in start_info:
-                                        line = start_info.get('line', 0)
-                                        col = start_info.get('column', 0)
-                                        start = line * 1000 + col
-                            structures.append({
-                                'type': 'return',
-                                'start': start
-                            })
-                            logger.info(f"Found return statement at position {start}")
-                except (json.JSONDecodeError, KeyError) as e:
-                    logger.warning(f"Failed to parse return pattern results: {e}")
+                        located = [
+                            (match['ruleId'], _match_offset(match))
+                            for match in matches
+                            if isinstance(match, dict) and match.get('ruleId') in _CONTROL_RULE_IDS
+                        ]
+                        for struct_type, start in located:
+                            structures.append(_control_structure(struct_type, start, function_code))
+                            logger.info(f"Found {struct_type} statement at position {start}")
+                except (orjson.JSONDecodeError, KeyError) as e:
+                    logger.warning(f"Failed to parse control structure scan results: {e}")
+                    logger.debug(f"ast-grep output: {result.stdout[:500].decode(errors='replace')}")
 
         except Exception as e:
             logger.error(f"Error analyzing control structures: {e}")
@@ -367,65 +628,23 @@ class CodeAnalyzer:
             return "\n".join(diagram_lines)
 
         # Build nodes and connections
-        node_id = 0
         current_node = "START"
-        
-        for struct in structures:
+
+        for node_id, struct in enumerate(structures):
             struct_type = struct['type']
-            
-            if struct_type == 'for':
-                loop_node = f"FOR{node_id}"
-                body_node = f"FORBODY{node_id}"
-                exit_node = f"FOREXIT{node_id}"
-                
-                diagram_lines.append(f"    {current_node} --> {loop_node}{{For Loop}}")
-                diagram_lines.append(f"    {loop_node} -->|True| {body_node}[Loop Body]")
-                diagram_lines.append(f"    {body_node} --> {loop_node}")
-                diagram_lines.append(f"    {loop_node} -->|False| {exit_node}[Continue]")
-                
-                current_node = body_node
-                node_id += 1
-                
-            elif struct_type == 'while':
-                loop_node = f"WHILE{node_id}"
-                body_node = f"WHILEBODY{node_id}"
-                exit_node = f"WHILEEXIT{node_id}"
-                
-                diagram_lines.append(f"    {current_node} --> {loop_node}{{While}}")
-                diagram_lines.append(f"    {loop_node} -->|True| {body_node}[Body]")
-                diagram_lines.append(f"    {body_node} --> {loop_node}")
-                diagram_lines.append(f"    {loop_node} -->|False| {exit_node}[Continue]")
-                
-                current_node = body_node
-                node_id += 1
-                
-            elif struct_type == 'if':
-                if_node = f"IF{node_id}"
-                then_node = f"THEN{node_id}"
-                else_node = f"ELSE{node_id}"
-                merge_node = f"MERGE{node_id}"
-                
-                has_else = struct.get('has_else', False)
-                
-                diagram_lines.append(f"    {current_node} --> {if_node}{{If}}")
-                diagram_lines.append(f"    {if_node} -->|Yes| {then_node}[Then]")
-                
-                if has_else:
-                    diagram_lines.append(f"    {if_node} -->|No| {else_node}[Else]")
-                    diagram_lines.append(f"    {then_node} --> {merge_node}[Continue]")
-                    diagram_lines.append(f"    {else_node} --> {merge_node}")
-                else:
-                    diagram_lines.append(f"    {if_node} -->|No| {merge_node}[Continue]")
-                    diagram_lines.append(f"    {then_node} --> {merge_node}")
-                
-                current_node = merge_node
-                node_id += 1
-                
-            elif struct_type == 'return':
-                return_node = f"RETURN{node_id}"
-                diagram_lines.append(f"    {current_node} --> {return_node}[Return]")
-                diagram_lines.append(f"    {return_node} --> END([End])")
+            if struct_type == 'if' and struct.get('has_else', False):
+                struct_type = 'if_else'
+
+            template = _FLOWCHART_TEMPLATES.get(struct_type)
+            if template is None:
+                continue
+            lines, next_node = template
+            diagram_lines.append(lines.format(prev=current_node, n=node_id))
+
+            if next_node is None:
+                # Return ends the flow
                 return "\n".join(diagram_lines)
+            current_node = next_node.format(n=node_id)
 
         # Connect to end
         diagram_lines.append(f"    {current_node} --> END([End])")
@@ -437,3 +656,6 @@ class CodeAnalyzer:
     A[{function_name}] --> B[Process]
     B --> C[Return]"""
     
+
+# Global analyzer instance shared by all job workers
+code_analyzer = CodeAnalyzer()
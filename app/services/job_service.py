@@ -1,13 +1,30 @@
+import bisect
+import queue
 import threading
+import time
 import uuid
-from typing import Dict, List
-from datetime import datetime
-from app.models.job import Job, JobStatus, FunctionResult
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List
+from collections import OrderedDict
+from datetime import timedelta
+from app.models.job import Job, JobStatus
+from app.services.code_analyzer import CodeAnalyzer, code_analyzer, hash_code
 import logging
-import asyncio
 
 logger = logging.getLogger(__name__)
 
+# Upper bound on functions analyzed in parallel within one job (ast-grep path only)
+MAX_FUNCTION_WORKERS = 8
+
+# Longest a finished diagram waits to be published with others from the same job
+PROGRESS_INTERVAL = 0.05
+
+# Retention for finished jobs; queued and running jobs are never evicted
+MAX_RETAINED_JOBS = 10_000
+JOB_TTL = timedelta(hours=24)
+
+_FINISHED_STATUSES = (JobStatus.SUCCESS, JobStatus.FAILED)
+
 # Import manager for broadcasting (avoid circular import)
 def get_manager():
     try:
@@ -18,28 +35,41 @@ def get_manager():
 
 class JobService:
     def __init__(self):
-        self.jobs: Dict[str, Job] = {}
+        # In creation order (updates reassign existing keys), so eviction pops from the front
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        # Guards the store and version counter; held only for O(1) operations
+        # and the listing copy
         self.lock = threading.Lock()
         self.worker_thread = None
-        self.job_queue = []
+        self.job_queue: queue.Queue = queue.Queue()
+        self._version = 0
         self.start_worker()
 
+    @property
+    def version(self) -> int:
+        """Counter bumped on every job change, used to invalidate cached listings"""
+        return self._version
+
     def create_job(self, code: str) -> str:
         """Create a new job and return its ID"""
         job_id = str(uuid.uuid4())
-        job = Job(id=job_id, code=code)
+        job = Job(id=job_id, code=code, code_hash=hash_code(code))
         
         with self.lock:
             self.jobs[job_id] = job
-            self.job_queue.append(job_id)
-        
+            self._evict_finished_jobs()
+            self._version += 1
+            version = self._version
+        self.job_queue.put(job_id)
+
+        self._notify_jobs_updated(job_id, version)
         logger.info(f"Created job {job_id}")
         return job_id
 
     def get_job(self, job_id: str) -> Job:
         """Get a job by ID"""
-        with self.lock:
-            return self.jobs.get(job_id)
+        # A single dict lookup is atomic, so readers don't contend with the worker
+        return self.jobs.get(job_id)
 
     def get_all_jobs(self) -> List[Job]:
         """Get all jobs"""
@@ -49,26 +79,99 @@ class JobService:
     def update_job(self, job: Job):
         """Update a job in storage"""
         with self.lock:
-            job.updated_at = datetime.now()
-            self.jobs[job.id] = job
+            version = self._store(job)
+        self._publish_update(job, version)
+
+    def add_function_results(self, job: Job, results: List[tuple]):
+        """Record a batch of (index, name, diagram) results under one lock and publish them together.
+
+        index is the function's source position; results finish out of order but
+        are kept in source order.
+        """
+        with self.lock:
+            for index, name, mermaid_diagram in results:
+                at = bisect.bisect(job.function_indexes, index)
+                job.function_indexes.insert(at, index)
+                job.function_names.insert(at, name)
+                job.mermaid_diagrams.insert(at, mermaid_diagram)
+            job.processed_functions += len(results)
+            version = self._store(job)
+
+        self._broadcast({
+            "type": "function_results",
+            "job_id": job.id,
+            "results": [
+                {"index": index, "name": name, "mermaid_diagram": mermaid_diagram}
+                for index, name, mermaid_diagram in results
+            ]
+        })
+        self._publish_update(job, version)
+
+    def _store(self, job: Job) -> int:
+        """Stamp and store job, returning the bumped listing version. Caller holds self.lock."""
+        job.updated_at_ns = time.time_ns()
+        self.jobs[job.id] = job
+        self._version += 1
+        return self._version
+
+    def _publish_update(self, job: Job, version: int):
+        """Announce a stored change to clients"""
+        self._notify_jobs_updated(job.id, version)
 
         # Broadcast job update to connected WebSocket clients
         try:
             manager = get_manager()
             if manager:
-                # Create update message
-                update_message = {
-                    "type": "job_update",
-                    "job_id": job.id,
-                    "status": job.status.value,
-                    "total_functions": job.total_functions,
-                    "processed_functions": job.processed_functions,
-                    "updated_at": job.updated_at.isoformat()
-                }
-                # Schedule broadcast in event loop
-                asyncio.create_task(manager.broadcast(update_message))
+                manager.broadcast_raw(self._job_update_payload(job), ("job_update", job.id))
+        except Exception as e:
+            logger.error(f"Failed to broadcast job_update: {e}")
+
+    def _evict_finished_jobs(self):
+        """Pop the oldest jobs while they are finished and expired or over the cap.
+
+        Caller holds self.lock. A job is expired once it is past JOB_TTL, and the
+        cap is MAX_RETAINED_JOBS. Stops at the first job that has to stay, so each
+        call only touches what it evicts; a still-running oldest job holds back
+        eviction until it finishes.
+        """
+        cutoff_ns = time.time_ns() - int(JOB_TTL.total_seconds() * 1e9)
+        while self.jobs:
+            oldest = next(iter(self.jobs.values()))
+            if oldest.status not in _FINISHED_STATUSES:
+                break
+            if len(self.jobs) <= MAX_RETAINED_JOBS and oldest.updated_at_ns >= cutoff_ns:
+                break
+            self.jobs.popitem(last=False)
+            logger.info(f"Evicted finished job {oldest.id}")
+
+    def _job_update_payload(self, job: Job) -> bytes:
+        """Encode a job_update message from the job's cached template"""
+        if job._update_template is None:
+            # Ids are uuid4 strings, so they need no JSON escaping
+            job._update_template = (
+                '{"type":"job_update","job_id":"%s",' % job.id
+                + '"status":"%s","total_functions":%d,"processed_functions":%d,"updated_at":"%s"}'
+            )
+        return (job._update_template % (
+            job.status.value,
+            job.total_functions,
+            job.processed_functions,
+            job.updated_at.isoformat()
+        )).encode()
+
+    def _notify_jobs_updated(self, job_id: str, version: int):
+        """Tell clients the job list changed so they re-poll only when needed"""
+        self._broadcast({"type": "jobs_updated", "version": version, "job_id": job_id})
+
+    def _broadcast(self, message: dict):
+        """Send a message to connected WebSocket clients"""
+        try:
+            manager = get_manager()
+            if manager:
+                # Hand off to the event loop; messages are coalesced into batch frames
+                manager.broadcast(message)
         except Exception as e:
-            logger.error(f"Failed to broadcast job update: {e}")
+            logger.error(f"Failed to broadcast {message.get('type')}: {e}")
 
     def start_worker(self):
         """Start the background worker thread"""
@@ -78,23 +181,22 @@ class JobService:
             logger.info("Started background worker thread")
 
     def _process_jobs(self):
-        """Background worker that processes jobs from the queue"""
-        from app.services.code_analyzer import CodeAnalyzer
-        
-        analyzer = CodeAnalyzer()
-        
+        """Background worker that processes jobs from the queue.
+
+        CodeAnalyzer does blocking, CPU-bound parsing (or shells out to ast-grep
+        when tree-sitter is not installed), so it must only ever run here and
+        never from a route or WebSocket handler on the event loop. Results reach
+        clients through manager.broadcast, which is thread-safe.
+        """
         while True:
-            job_id = None
-            with self.lock:
-                if self.job_queue:
-                    job_id = self.job_queue.pop(0)
-            
+            # Blocks until a job is queued instead of spinning on the lock
+            job_id = self.job_queue.get()
             if job_id:
                 try:
                     job = self.get_job(job_id)
                     if job:
                         logger.info(f"Processing job {job_id}")
-                        self._process_job(job, analyzer)
+                        self._process_job(job, code_analyzer)
                 except Exception as e:
                     logger.error(f"Error processing job {job_id}: {e}")
                     job = self.get_job(job_id)
@@ -103,51 +205,74 @@ class JobService:
                         job.error_message = str(e)
                         self.update_job(job)
 
-    def _process_job(self, job: Job, analyzer: 'CodeAnalyzer'):
+    def _generate_diagrams(self, job: Job, functions: List[str], analyzer: CodeAnalyzer):
+        """Yield (index, name, diagram, error) for each function as its diagram is ready"""
+        if not analyzer.uses_subprocesses:
+            # In-process parsing holds the GIL, so a thread pool would only add overhead
+            for index, func_name in enumerate(functions):
+                try:
+                    diagram, error = analyzer.generate_mermaid_diagram(job.code, func_name, job.code_hash), None
+                except Exception as e:
+                    diagram, error = None, e
+                yield index, func_name, diagram, error
+            return
+
+        # Each diagram is independent and mostly waits on ast-grep subprocesses
+        with ThreadPoolExecutor(max_workers=min(MAX_FUNCTION_WORKERS, len(functions))) as executor:
+            futures = {
+                executor.submit(
+                    analyzer.generate_mermaid_diagram, job.code, func_name, job.code_hash
+                ): (index, func_name)
+                for index, func_name in enumerate(functions)
+            }
+            for future in as_completed(futures):
+                try:
+                    diagram, error = future.result(), None
+                except Exception as e:
+                    diagram, error = None, e
+                yield (*futures[future], diagram, error)
+
+    def _process_job(self, job: Job, analyzer: CodeAnalyzer):
         """Process a single job"""
         try:
             # Update status to in progress
             job.status = JobStatus.IN_PROGRESS
             self.update_job(job)
             
-            # Step 1: Find functions using ast-grep
-            functions = analyzer.find_functions(job.code)
+            # Step 1: Find function definitions
+            functions = analyzer.find_functions(job.code, job.code_hash)
             job.total_functions = len(functions)
             self.update_job(job)
 
             logger.info(f"Found {len(functions)} functions in job {job.id}")
             
-            # Step 2: Process each function
-            for func_name in functions:
-                try:
-                    # Generate Mermaid diagram using LLM
-                    mermaid_diagram = analyzer.generate_mermaid_diagram(job.code, func_name)
-
-                    function_result = FunctionResult(
-                        name=func_name,
-                        mermaid_diagram=mermaid_diagram
-                    )
-                    job.functions.append(function_result)
-                    logger.info(f"Added function result for {func_name}")
-
-                    job.processed_functions += 1
-                    self.update_job(job)
-                    
-                except Exception as e:
-                    logger.error(f"Error processing function {func_name}: {e}")
-                    # Still add the function result even if processing failed, with empty diagram
-                    function_result = FunctionResult(
-                        name=func_name,
-                        mermaid_diagram=f"flowchart TD\n    A[{func_name}] --> B[Error: {str(e)[:50]}]"
-                    )
-                    job.functions.append(function_result)
-                    job.processed_functions += 1
-                    self.update_job(job)
-            
+            # Step 2: Generate a diagram per function
+            if functions:
+                # Results are recorded about ten at a time per job, or sooner when
+                # diagrams are slow, so progress never trails by more than PROGRESS_INTERVAL
+                step = max(1, len(functions) // 10)
+                pending = []
+                last_flush = time.monotonic()
+                for index, func_name, diagram, error in self._generate_diagrams(job, functions, analyzer):
+                    if error is None:
+                        logger.info(f"Generated diagram for {func_name}")
+                    else:
+                        logger.error(f"Error processing function {func_name}: {error}")
+                        # Still add the function result even if processing failed, with empty diagram
+                        diagram = f"flowchart TD\n    A[{func_name}] --> B[Error: {str(error)[:50]}]"
+                    pending.append((index, func_name, diagram))
+
+                    if len(pending) >= step or time.monotonic() - last_flush >= PROGRESS_INTERVAL:
+                        self.add_function_results(job, pending)
+                        pending = []
+                        last_flush = time.monotonic()
+                if pending:
+                    self.add_function_results(job, pending)
+
             # Step 3: Mark job as complete
             job.status = JobStatus.SUCCESS
             self.update_job(job)
-            logger.info(f"Completed job {job.id} with {len(job.functions)} functions")
+            logger.info(f"Completed job {job.id} with {len(job.function_names)} functions")
             
         except Exception as e:
             logger.error(f"Job {job.id} failed: {e}")
@@ -6,6 +6,11 @@ function JobDashboard({ onJobSelected, onCreateJob, refreshTrigger }) {
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState(null);
   const wsRef = useRef(null);
+  const jobsRef = useRef([]);
+
+  useEffect(() => {
+    jobsRef.current = jobs;
+  }, [jobs]);
 
   const fetchJobs = useCallback(async () => {
     try {
@@ -29,16 +34,28 @@ function JobDashboard({ onJobSelected, onCreateJob, refreshTrigger }) {
 
     ws.onmessage = (event) => {
       try {
-        const update = JSON.parse(event.data);
-        if (update.type === 'job_update') {
-          // Update job status in the jobs list
-          setJobs(prevJobs =>
-            prevJobs.map(job =>
-              job.id === update.job_id
-                ? { ...job, status: update.status, processed_functions: update.processed_functions, updated_at: update.updated_at }
-                : job
-            )
-          );
+        const message = JSON.parse(event.data);
+        // Updates arrive coalesced into batch frames
+        const updates = message.type === 'batch' ? message.items : [message];
+        let listChanged = false;
+        updates.forEach(update => {
+          if (update.type === 'jobs_updated' && !jobsRef.current.some(job => job.id === update.job_id)) {
+            listChanged = true;
+          }
+          if (update.type === 'job_update') {
+            // Update job status in the jobs list
+            setJobs(prevJobs =>
+              prevJobs.map(job =>
+                job.id === update.job_id
+                  ? { ...job, status: update.status, processed_functions: update.processed_functions, updated_at: update.updated_at }
+                  : job
+              )
+            );
+          }
+        });
+        // Status changes are applied in place; only re-fetch when a job we don't have appears
+        if (listChanged) {
+          fetchJobs();
         }
       } catch (err) {
         console.error('Failed to parse WebSocket message:', err);
@@ -56,7 +73,7 @@ function JobDashboard({ onJobSelected, onCreateJob, refreshTrigger }) {
     };
 
     wsRef.current = ws;
-  }, []);
+  }, [fetchJobs]);
 
 
   useEffect(() => {
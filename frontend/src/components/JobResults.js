@@ -1,27 +1,109 @@
-import React, { useState, useEffect, useCallback } from 'react';
+import React, { useState, useEffect, useCallback, useRef } from 'react';
 import { api } from '../api';
 import MermaidDiagram from './MermaidDiagram';
 
+// Insert a function result in source order by index; a result already fetched is replaced
+const placeResult = (functions, result) => {
+  const placed = functions.filter(func => func.index !== result.index);
+  const at = placed.findIndex(func => func.index > result.index);
+  placed.splice(at === -1 ? placed.length : at, 0, result);
+  return placed;
+};
+
+// Apply one WebSocket update for this job to the fetched job details
+const applyUpdate = (job, update) => {
+  if (update.type === 'function_results') {
+    return { ...job, functions: update.results.reduce(placeResult, job.functions) };
+  }
+  if (update.type === 'job_update') {
+    return {
+      ...job,
+      status: update.status,
+      total_functions: update.total_functions,
+      processed_functions: update.processed_functions,
+      updated_at: update.updated_at
+    };
+  }
+  return job;
+};
+
 function JobResults({ jobId }) {
   const [job, setJob] = useState(null);
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState(null);
+  const wsRef = useRef(null);
+  // Updates received while job details are being fetched, replayed onto the response
+  const pendingRef = useRef([]);
+  const fetchingRef = useRef(true);
 
   const fetchJobDetails = useCallback(async () => {
+    fetchingRef.current = true;
     try {
       const jobData = await api.getJob(jobId);
-      setJob(jobData);
+      const pending = pendingRef.current;
+      pendingRef.current = [];
+      setJob(pending.reduce(applyUpdate, jobData));
       setError(null);
     } catch (err) {
+      pendingRef.current = [];
       setError(err.message);
     } finally {
+      fetchingRef.current = false;
       setLoading(false);
     }
   }, [jobId]);
 
   useEffect(() => {
+    let closed = false;
+
+    const connectWebSocket = () => {
+      const ws = new WebSocket(`ws://localhost:8080/ws/jobs`);
+
+      ws.onmessage = (event) => {
+        try {
+          const message = JSON.parse(event.data);
+          // Updates arrive coalesced into batch frames
+          const updates = message.type === 'batch' ? message.items : [message];
+          const own = updates.filter(update => update.job_id === jobId);
+          if (own.length === 0) {
+            return;
+          }
+          if (fetchingRef.current) {
+            pendingRef.current.push(...own);
+          } else {
+            setJob(prevJob => prevJob && own.reduce(applyUpdate, prevJob));
+          }
+        } catch (err) {
+          console.error('Failed to parse WebSocket message:', err);
+        }
+      };
+
+      ws.onclose = () => {
+        if (!closed) {
+          // Reconnect and re-fetch to pick up anything missed while disconnected
+          setTimeout(() => {
+            if (!closed) {
+              connectWebSocket();
+              fetchJobDetails();
+            }
+          }, 5000);
+        }
+      };
+
+      wsRef.current = ws;
+    };
+
+    // Subscribe before fetching so no result lands between the two
+    connectWebSocket();
     fetchJobDetails();
-  }, [fetchJobDetails]);
+
+    return () => {
+      closed = true;
+      if (wsRef.current) {
+        wsRef.current.close();
+      }
+    };
+  }, [jobId, fetchJobDetails]);
 
   if (loading) {
     return <div className="loading">Loading job results...</div>;